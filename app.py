@@ -1,8 +1,11 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import plotly.express as px
-import time
 
 # ==============================
 # PAGE CONFIG
@@ -37,50 +40,102 @@ st.title("🧠 Clinical Trial Intelligence Dashboard")
 # FETCH DATA FROM CLINICALTRIALS.GOV
 # ==============================
 
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False
+        )
+    ))
+    session.headers.update({"Accept": "application/json", "Accept-Encoding": "gzip"})
+    return session
+
+MAX_PAGES = 10
+
+CATEGORY_COLUMNS = ("Phase", "Status", "Sponsor", "Country")
+
+FIELD_COLUMNS = {
+    "protocolSection.identificationModule.nctId": "NCTId",
+    "protocolSection.designModule.phases": "Phase",
+    "protocolSection.sponsorCollaboratorsModule.leadSponsor.name": "Sponsor",
+    "protocolSection.statusModule.overallStatus": "Status",
+    "protocolSection.designModule.enrollmentInfo.count": "Enrollment",
+    "protocolSection.contactsLocationsModule.locations": "Country",
+}
+
+# Raised instead of returning so st.cache_data never stores a partial result;
+# df holds whatever was fetched before the failing page
+class TrialFetchError(Exception):
+    def __init__(self, df):
+        super().__init__("clinicaltrials.gov request failed")
+        self.df = df
+
+
+def studies_to_frame(studies):
+    if not studies:
+        return pd.DataFrame()
+
+    df = pd.json_normalize(studies)
+    df = df.reindex(columns=list(FIELD_COLUMNS)).rename(columns=FIELD_COLUMNS)
+
+    df["Phase"] = df["Phase"].fillna("None").astype(str)
+
+    # Extract first country if available
+    df["Country"] = df["Country"].astype(object).str[0].str.get("country")
+
+    df["Enrollment"] = pd.to_numeric(df["Enrollment"], errors="coerce")
+
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].astype("category")
+
+    return df
+
+
+# Returns (df, truncated); truncated is True when MAX_PAGES cut the results short
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
 def fetch_trials(disease):
     base_url = "https://clinicaltrials.gov/api/v2/studies"
 
     params = {
         "query.term": disease,
+        "fields": "NCTId,Phase,LeadSponsorName,OverallStatus,EnrollmentCount,LocationCountry",
+        "format": "json",
         "pageSize": 500
     }
 
-    response = requests.get(base_url, params=params)
+    studies = []
 
-    if response.status_code != 200:
-        return pd.DataFrame()
+    # The v2 API paginates with an opaque cursor, so pages are fetched in order
+    for _ in range(MAX_PAGES):
+        try:
+            response = get_http_session().get(base_url, params=params, timeout=(5, 30))
+            data = orjson.loads(response.content) if response.status_code == 200 else None
+        except (requests.RequestException, orjson.JSONDecodeError):
+            data = None
 
-    data = response.json()
+        if data is None:
+            raise TrialFetchError(studies_to_frame(studies))
 
-    if "studies" not in data:
-        return pd.DataFrame()
-
-    records = []
-
-    for study in data["studies"]:
-        protocol = study.get("protocolSection", {})
+        studies.extend(data.get("studies", []))
 
-        record = {
-            "NCTId": protocol.get("identificationModule", {}).get("nctId"),
-            "Phase": str(protocol.get("designModule", {}).get("phases")),
-            "Sponsor": protocol.get("sponsorCollaboratorsModule", {}).get("leadSponsor", {}).get("name"),
-            "Status": protocol.get("statusModule", {}).get("overallStatus"),
-            "Enrollment": protocol.get("designModule", {}).get("enrollmentInfo", {}).get("count"),
-            "Country": None
-        }
+        next_page_token = data.get("nextPageToken")
+        if not next_page_token:
+            break
 
-        # Extract first country if available
-        locations = protocol.get("contactsLocationsModule", {}).get("locations")
-        if locations and isinstance(locations, list):
-            record["Country"] = locations[0].get("country")
+        params["pageToken"] = next_page_token
 
-        records.append(record)
+    return studies_to_frame(studies), bool(next_page_token)
 
-    df = pd.DataFrame(records)
-
-    df["Enrollment"] = pd.to_numeric(df["Enrollment"], errors="coerce")
 
-    return df
+@st.cache_data(max_entries=16, show_spinner=False)
+def to_csv_bytes(df):
+    return df.to_csv(index=False).encode("utf-8")
 
 
 # ==============================
@@ -107,18 +162,6 @@ with st.sidebar.expander("⚙ Advanced Filters"):
     enrollment_range = st.slider("Enrollment Range", 0, 5000, (0, 1000))
 
 
-# ==============================
-# ANIMATED METRIC FUNCTION
-# ==============================
-
-def animated_metric(label, value):
-    placeholder = st.empty()
-    for i in range(0, int(value)+1, max(1, int(value)//50 if value > 50 else 1)):
-        placeholder.metric(label, i)
-        time.sleep(0.01)
-    placeholder.metric(label, value)
-
-
 # ==============================
 # GENERATE DASHBOARD
 # ==============================
@@ -126,27 +169,46 @@ def animated_metric(label, value):
 if st.sidebar.button("Generate Dashboard"):
 
     with st.spinner("Fetching Clinical Trial Data..."):
-        df = fetch_trials(disease)
+        try:
+            df, truncated = fetch_trials(disease)
+            fetch_failed = False
+        except TrialFetchError as exc:
+            df, truncated = exc.df, False
+            fetch_failed = True
 
     if df.empty:
         st.warning("No trials found.")
     else:
 
-        # Apply Filters
+        if fetch_failed:
+            st.warning(f"clinicaltrials.gov stopped responding after {len(df)} trials; results are incomplete.")
+
+        if truncated:
+            st.warning(f"Showing the first {len(df)} matching trials; refine the search to see the rest.")
+
+        # Apply Filters as one combined mask so the frame is indexed once
+        mask = df["Enrollment"].between(enrollment_range[0], enrollment_range[1])
+
         if phase_filter != "All":
-            df = df[df["Phase"].str.contains(phase_filter, na=False)]
+            mask &= df["Phase"].str.contains(phase_filter, na=False, regex=False)
 
         if country_filter:
-            df = df[df["Country"].str.contains(country_filter, case=False, na=False)]
+            country_lc = df["Country"].str.lower()
+            mask &= country_lc.str.contains(country_filter.lower(), na=False, regex=False)
 
         if sponsor_filter:
-            df = df[df["Sponsor"].str.contains(sponsor_filter, case=False, na=False)]
+            sponsor_lc = df["Sponsor"].str.lower()
+            mask &= sponsor_lc.str.contains(sponsor_filter.lower(), na=False, regex=False)
 
         if status_filter != "All":
-            df = df[df["Status"] == status_filter]
+            mask &= df["Status"] == status_filter
+
+        df = df.loc[mask]
 
-        df = df[(df["Enrollment"] >= enrollment_range[0]) &
-                (df["Enrollment"] <= enrollment_range[1])]
+        # Keep value_counts from reporting categories the filters removed
+        df = df.assign(**{col: df[col].cat.remove_unused_categories() for col in CATEGORY_COLUMNS})
+
+        counts = {col: df[col].value_counts() for col in CATEGORY_COLUMNS}
 
         # ==============================
         # KPI METRICS
@@ -156,17 +218,11 @@ if st.sidebar.button("Generate Dashboard"):
 
         col1, col2, col3, col4 = st.columns(4)
 
-        with col1:
-            animated_metric("Total Trials", len(df))
-
-        with col2:
-            animated_metric("Unique Sponsors", df["Sponsor"].nunique())
-
-        with col3:
-            animated_metric("Countries Covered", df["Country"].nunique())
-
-        with col4:
-            animated_metric("Avg Enrollment", int(df["Enrollment"].mean() if not df["Enrollment"].isna().all() else 0))
+        col1.metric("Total Trials", len(df))
+        col2.metric("Unique Sponsors", len(counts["Sponsor"]))
+        col3.metric("Countries Covered", len(counts["Country"]))
+        col4.metric("Avg Enrollment",
+                    int(df["Enrollment"].mean() if not df["Enrollment"].isna().all() else 0))
 
         # ==============================
         # INTERACTIVE WORLD MAP
@@ -174,7 +230,7 @@ if st.sidebar.button("Generate Dashboard"):
 
         st.markdown("## 🌍 Global Distribution")
 
-        country_counts = df["Country"].value_counts().reset_index()
+        country_counts = counts["Country"].reset_index()
         country_counts.columns = ["Country", "Trials"]
 
         fig_map = px.choropleth(
@@ -197,21 +253,29 @@ if st.sidebar.button("Generate Dashboard"):
 
         with colA:
             st.subheader("Phase Distribution")
-            st.bar_chart(df["Phase"].value_counts())
+            st.bar_chart(counts["Phase"])
 
         with colB:
             st.subheader("Status Distribution")
-            st.bar_chart(df["Status"].value_counts())
+            st.bar_chart(counts["Status"])
 
         colC, colD = st.columns(2)
 
         with colC:
             st.subheader("Top Sponsors")
-            st.bar_chart(df["Sponsor"].value_counts().head(10))
+            st.bar_chart(counts["Sponsor"].head(10))
 
         with colD:
             st.subheader("Enrollment Distribution")
-            st.bar_chart(df["Enrollment"].fillna(0))
+            # Bin server-side so the browser draws 30 bars instead of one per trial
+            enrollment_counts, enrollment_edges = np.histogram(df["Enrollment"].dropna(), bins=30)
+            fig_enrollment = px.bar(
+                x=(enrollment_edges[:-1] + enrollment_edges[1:]) / 2,
+                y=enrollment_counts,
+                labels={"x": "Enrollment", "y": "Trials"}
+            )
+            fig_enrollment.update_traces(width=np.diff(enrollment_edges))
+            st.plotly_chart(fig_enrollment, use_container_width=True)
 
         # ==============================
         # AI INSIGHT PANEL (Basic Auto Insight)
@@ -221,9 +285,9 @@ if st.sidebar.button("Generate Dashboard"):
 
         summary_text = f"""
         Total Trials: {len(df)}
-        Top Sponsors: {df["Sponsor"].value_counts().head(3).to_string()}
-        Phase Distribution: {df["Phase"].value_counts().to_string()}
-        Countries Covered: {df["Country"].nunique()}
+        Top Sponsors: {counts["Sponsor"].head(3).to_string()}
+        Phase Distribution: {counts["Phase"].to_string()}
+        Countries Covered: {len(counts["Country"])}
         """
 
         # Simple built-in AI-style summary (no external API required)
@@ -231,7 +295,7 @@ if st.sidebar.button("Generate Dashboard"):
         The dataset shows {len(df)} active clinical trials.
         Phase concentration suggests strong development focus in dominant phases.
         Sponsor diversity indicates competitive landscape.
-        Geographic spread across {df["Country"].nunique()} countries reflects international research activity.
+        Geographic spread across {len(counts["Country"])} countries reflects international research activity.
         """
 
         st.markdown(f"""
@@ -250,6 +314,7 @@ if st.sidebar.button("Generate Dashboard"):
 
         st.download_button(
             "Download Full Dataset (CSV)",
-            df.to_csv(index=False),
-            "clinical_trials.csv"
+            to_csv_bytes(df),
+            "clinical_trials.csv",
+            mime="text/csv"
         )
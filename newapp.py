@@ -1,7 +1,12 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import urllib3
 import re
+import ijson
 
 # ============================================
 # PAGE CONFIG
@@ -24,53 +29,114 @@ st.warning(
 # FETCH DATA FROM CLINICALTRIALS.GOV
 # ============================================
 
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False
+        )
+    ))
+    session.headers.update({"Accept": "application/json", "Accept-Encoding": "gzip"})
+    return session
+
+MAX_PAGES = 10
+
+CATEGORY_COLUMNS = ("Phase", "Status", "Sponsor")
+
+FIELD_COLUMNS = {
+    "protocolSection.identificationModule.nctId": "NCTId",
+    "protocolSection.identificationModule.briefTitle": "Title",
+    "protocolSection.designModule.phases": "Phase",
+    "protocolSection.sponsorCollaboratorsModule.leadSponsor.name": "Sponsor",
+    "protocolSection.statusModule.overallStatus": "Status",
+    "protocolSection.designModule.enrollmentInfo.count": "Enrollment",
+    "protocolSection.eligibilityModule.eligibilityCriteria": "_eligibility",
+}
+
+def track_page_token(events, page):
+    for prefix, event, value in events:
+        if prefix == "nextPageToken":
+            page["nextPageToken"] = value
+        yield prefix, event, value
+
+# Raised instead of returning so st.cache_data never stores a partial result;
+# df holds whatever was fetched before the failing page
+class TrialFetchError(Exception):
+    def __init__(self, df):
+        super().__init__("clinicaltrials.gov request failed")
+        self.df = df
+
+def studies_to_frame(studies):
+    if not studies:
+        return pd.DataFrame()
+
+    df = pd.json_normalize(studies)
+    df = df.reindex(columns=list(FIELD_COLUMNS)).rename(columns=FIELD_COLUMNS)
+
+    df["Phase"] = df["Phase"].fillna("None").astype(str)
+
+    eligibility = df.pop("_eligibility").astype(object)
+    parts = eligibility.str.split("Exclusion Criteria:", n=1, expand=True).reindex(columns=[0, 1])
+    df["Inclusion"] = parts[0]
+    df["Exclusion"] = parts[1]
+
+    df["Enrollment"] = pd.to_numeric(df["Enrollment"], errors="coerce")
+
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].astype("category")
+
+    return df
+
+# Returns (df, truncated); truncated is True when MAX_PAGES cut the results short
 @st.cache_data(show_spinner=False)
 def fetch_trials(disease):
     base_url = "https://clinicaltrials.gov/api/v2/studies"
-    params = {"query.term": disease, "pageSize": 200}
-    response = requests.get(base_url, params=params)
+    params = {
+        "query.term": disease,
+        "fields": "NCTId,BriefTitle,Phase,LeadSponsorName,OverallStatus,EnrollmentCount,EligibilityCriteria",
+        "format": "json",
+        "pageSize": 200
+    }
 
-    if response.status_code != 200:
-        return pd.DataFrame()
+    studies = []
 
-    data = response.json()
-    if "studies" not in data:
-        return pd.DataFrame()
+    # The v2 API paginates with an opaque cursor, so pages are fetched in order
+    for _ in range(MAX_PAGES):
+        page = {}
+        page_studies = None
 
-    records = []
+        # Stream studies out of the body instead of materializing the whole JSON
+        try:
+            with get_http_session().get(base_url, params=params, timeout=(5, 30), stream=True) as response:
+                if response.status_code == 200:
+                    response.raw.decode_content = True
+                    events = ijson.parse(response.raw, use_float=True)
+                    page_studies = list(ijson.items(track_page_token(events, page), "studies.item"))
+        except (requests.RequestException, urllib3.exceptions.HTTPError, ijson.JSONError):
+            page_studies = None
 
-    for study in data["studies"]:
-        protocol = study.get("protocolSection", {})
+        if page_studies is None:
+            raise TrialFetchError(studies_to_frame(studies))
 
-        eligibility_text = protocol.get("eligibilityModule", {}).get("eligibilityCriteria")
+        studies.extend(page_studies)
 
-        inclusion = None
-        exclusion = None
+        if not page.get("nextPageToken"):
+            break
 
-        if eligibility_text:
-            if "Exclusion Criteria:" in eligibility_text:
-                inclusion = eligibility_text.split("Exclusion Criteria:")[0]
-                exclusion = eligibility_text.split("Exclusion Criteria:")[1]
-            else:
-                inclusion = eligibility_text
+        params["pageToken"] = page["nextPageToken"]
 
-        record = {
-            "NCTId": protocol.get("identificationModule", {}).get("nctId"),
-            "Title": protocol.get("identificationModule", {}).get("briefTitle"),
-            "Phase": str(protocol.get("designModule", {}).get("phases")),
-            "Sponsor": protocol.get("sponsorCollaboratorsModule", {}).get("leadSponsor", {}).get("name"),
-            "Status": protocol.get("statusModule", {}).get("overallStatus"),
-            "Enrollment": protocol.get("designModule", {}).get("enrollmentInfo", {}).get("count"),
-            "Inclusion": inclusion,
-            "Exclusion": exclusion
-        }
+    return studies_to_frame(studies), bool(page.get("nextPageToken"))
 
-        records.append(record)
 
-    df = pd.DataFrame(records)
-    df["Enrollment"] = pd.to_numeric(df["Enrollment"], errors="coerce")
-
-    return df
+@st.cache_data(max_entries=16, show_spinner=False)
+def to_csv_bytes(df):
+    return df.to_csv(index=False).encode("utf-8")
 
 
 # ============================================
@@ -84,12 +150,30 @@ if not disease:
     st.info("Enter a disease in sidebar to begin.")
     st.stop()
 
-df = fetch_trials(disease)
+fetch_failed = False
+
+# Reuse the fetched frame across reruns until the disease changes
+if st.session_state.get("_disease") != disease:
+    try:
+        st.session_state["df"], st.session_state["truncated"] = fetch_trials(disease)
+        st.session_state["_disease"] = disease
+    except TrialFetchError as exc:
+        # Leave _disease untouched so the next rerun retries the fetch
+        st.session_state["df"], st.session_state["truncated"] = exc.df, False
+        fetch_failed = True
+
+df = st.session_state["df"]
 
 if df.empty:
     st.error("No trials found.")
     st.stop()
 
+if fetch_failed:
+    st.warning(f"clinicaltrials.gov stopped responding after {len(df)} trials; results are incomplete.")
+
+if st.session_state["truncated"]:
+    st.warning(f"Showing the first {len(df)} matching trials; refine the search to see the rest.")
+
 # ============================================
 # TABS STRUCTURE
 # ============================================
@@ -104,30 +188,33 @@ with tab1:
 
     st.subheader("📊 Trial Analytics")
 
+    counts = {col: df[col].value_counts() for col in CATEGORY_COLUMNS}
+
     col1, col2, col3, col4 = st.columns(4)
 
     col1.metric("Total Trials", len(df))
-    col2.metric("Unique Sponsors", df["Sponsor"].nunique())
-    col3.metric("Phases Covered", df["Phase"].nunique())
+    col2.metric("Unique Sponsors", len(counts["Sponsor"]))
+    col3.metric("Phases Covered", len(counts["Phase"]))
     col4.metric("Avg Enrollment",
                 int(df["Enrollment"].mean() if not df["Enrollment"].isna().all() else 0))
 
     st.markdown("### Phase Distribution")
-    st.bar_chart(df["Phase"].value_counts())
+    st.bar_chart(counts["Phase"])
 
     st.markdown("### Status Distribution")
-    st.bar_chart(df["Status"].value_counts())
+    st.bar_chart(counts["Status"])
 
     st.markdown("### Top Sponsors")
-    st.bar_chart(df["Sponsor"].value_counts().head(10))
+    st.bar_chart(counts["Sponsor"].head(10))
 
     st.markdown("### Data Preview")
     st.dataframe(df[["NCTId", "Title", "Phase", "Sponsor", "Status"]].head(20))
 
     st.download_button(
         "Download Trial Dataset",
-        df.to_csv(index=False),
-        "trial_dataset.csv"
+        to_csv_bytes(df),
+        "trial_dataset.csv",
+        mime="text/csv"
     )
 
 
@@ -135,6 +222,10 @@ with tab1:
 # TAB 2 — ELIGIBILITY MATCHER
 # ============================================
 
+PREGNANCY_PATTERN = re.compile(r"pregnant", re.IGNORECASE)
+RENAL_PATTERN = re.compile(r"renal|kidney", re.IGNORECASE)
+CANCER_PATTERN = re.compile(r"cancer|malignancy", re.IGNORECASE)
+
 with tab2:
 
     st.subheader("🧬 Patient Eligibility Matching")
@@ -148,57 +239,54 @@ with tab2:
     renal_disease = st.selectbox("Renal Disease?", ["No", "Yes"])
     cancer_history = st.selectbox("History of Cancer?", ["No", "Yes"])
 
-    def text_contains(text, keywords):
-        if not text:
-            return False
-        text = text.lower()
-        return any(k.lower() in text for k in keywords if k)
-
-    def evaluate_eligibility(row):
-        score = 0
-        reasons = []
+    def keyword_mask(text, pattern, enabled=True):
+        if not enabled:
+            return pd.Series(False, index=text.index)
+        return text.str.contains(pattern, na=False)
 
-        inclusion = row["Inclusion"] or ""
-        exclusion = row["Exclusion"] or ""
+    def evaluate_eligibility(df):
+        inclusion = df["Inclusion"].fillna("")
+        exclusion = df["Exclusion"].fillna("")
 
         # Inclusion match
-        if text_contains(inclusion, [patient_diagnosis]):
-            score += 3
+        diagnosis_pattern = re.compile(re.escape(patient_diagnosis), re.IGNORECASE)
+        diagnosis_hit = keyword_mask(inclusion, diagnosis_pattern, bool(patient_diagnosis))
 
         # Basic age heuristic
-        if str(patient_age) in inclusion:
-            score += 1
+        age_hit = keyword_mask(inclusion, re.compile(rf"\b{patient_age}\b"))
 
         # Exclusion checks
-        if pregnant == "Yes" and text_contains(exclusion, ["pregnant"]):
-            score -= 5
-            reasons.append("Pregnancy exclusion")
+        exclusions = {
+            "Pregnancy exclusion": (keyword_mask(exclusion, PREGNANCY_PATTERN, pregnant == "Yes"), 5),
+            "Renal exclusion": (keyword_mask(exclusion, RENAL_PATTERN, renal_disease == "Yes"), 4),
+            "Cancer exclusion": (keyword_mask(exclusion, CANCER_PATTERN, cancer_history == "Yes"), 4),
+        }
 
-        if renal_disease == "Yes" and text_contains(exclusion, ["renal", "kidney"]):
-            score -= 4
-            reasons.append("Renal exclusion")
+        score = 3 * diagnosis_hit.astype(int) + age_hit.astype(int)
+        reasons = pd.Series("", index=df.index)
 
-        if cancer_history == "Yes" and text_contains(exclusion, ["cancer", "malignancy"]):
-            score -= 4
-            reasons.append("Cancer exclusion")
+        for reason, (mask, penalty) in exclusions.items():
+            score -= penalty * mask.astype(int)
+            reasons = reasons.where(~mask, reasons + ", " + reason)
 
-        if score >= 3:
-            label = "Likely Eligible"
-        elif score >= 1:
-            label = "Possibly Eligible"
-        else:
-            label = "Not Eligible"
+        label = np.select(
+            [score >= 3, score >= 1],
+            ["Likely Eligible", "Possibly Eligible"],
+            default="Not Eligible"
+        )
 
-        return score, label, ", ".join(reasons)
+        return score, label, reasons.str.lstrip(", ")
 
     if st.button("Evaluate Patient"):
 
-        df[["EligibilityScore", "EligibilityLabel", "ExclusionReasons"]] = df.apply(
-            lambda row: pd.Series(evaluate_eligibility(row)),
-            axis=1
-        )
+        score, label, reasons = evaluate_eligibility(df)
 
-        df_sorted = df.sort_values("EligibilityScore", ascending=False)
+        # Score a copy so the frame held in session_state stays untouched
+        df_sorted = df.assign(
+            EligibilityScore=score,
+            EligibilityLabel=label,
+            ExclusionReasons=reasons
+        ).sort_values("EligibilityScore", ascending=False)
 
         colX, colY, colZ = st.columns(3)
 
@@ -235,6 +323,7 @@ with tab2:
 
         st.download_button(
             "Download Eligibility Results",
-            df_sorted.to_csv(index=False),
-            "eligibility_results.csv"
+            to_csv_bytes(df_sorted),
+            "eligibility_results.csv",
+            mime="text/csv"
         )